@@ -6,21 +6,49 @@ Role: Financial Data Analyst specializing in currency conversion rates
 import asyncio
 import json
 import os
+import sys
+import time
 import datetime
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+import functools
+import contextlib
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
 from claude_agent_sdk import query, ClaudeAgentOptions
 from claude_agent_sdk.types import Message, AssistantMessage, ResultMessage, TextBlock, ToolUseBlock, ToolResultBlock
 from dotenv import load_dotenv
 from typing import AsyncGenerator
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+
 load_dotenv()
 
+def _json_dumps(obj) -> bytes:
+    """
+    Serialize to UTF-8 JSON bytes, using orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+class ORJSONResponse(Response):
+    """
+    JSON response rendered with _json_dumps, skipping FastAPI's stdlib encoder
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return _json_dumps(content)
+
 app = FastAPI(
     title="Currency Rate Analyst",
     description="Financial Data Analyst specializing in currency conversion rates",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 class QueryRequest(BaseModel):
@@ -42,7 +70,7 @@ class StreamEvent(BaseModel):
 AGENT_CONFIG = {
     "name": "Currency Rate Analyst",
     "role": "Financial Data Analyst specializing in currency conversion rates",
-    "tools": ['WebSearch', 'WebFetch', 'Read', 'Write', 'Bash'],
+    "tools": ('WebSearch', 'WebFetch', 'Read', 'Write', 'Bash'),
     "system_prompt": """You are a Currency Rate Analyst, an expert financial data analyst specializing in currency conversion rates. Your primary responsibility is to gather accurate, real-time exchange rates for major world currencies and present them in well-structured Excel files.
 
 Your core competencies include:
@@ -65,105 +93,188 @@ Your personality is analytical, detail-oriented, and precise. You present financ
     "permission_mode": "acceptEdits"
 }
 
+@functools.lru_cache(maxsize=64)
+def _options_for(max_turns: int) -> ClaudeAgentOptions:
+    """
+    Claude Agent SDK options for a given turn limit, shared across requests;
+    the SDK only reads them, so one instance per max_turns is reused
+    """
+    return ClaudeAgentOptions(
+        allowed_tools=AGENT_CONFIG["tools"],
+        system_prompt=AGENT_CONFIG["system_prompt"],
+        permission_mode=AGENT_CONFIG["permission_mode"],
+        max_turns=max_turns,
+    )
+
+# Static endpoint bodies, serialized once at import time
+_ROOT_BODY = _json_dumps({
+    "message": "Welcome to Currency Rate Analyst",
+    "role": "Financial Data Analyst specializing in currency conversion rates",
+    "agent_id": "ui_user_2e538485",
+    "endpoints": [
+        "/query - POST: Send a task to the agent",
+        "/stream - POST: Stream agent progress in real-time",
+        "/info - GET: Get agent information",
+        "/health - GET: Check service health"
+    ]
+})
+_INFO_BODY = _json_dumps({
+    "agent_id": "ui_user_2e538485",
+    "name": AGENT_CONFIG["name"],
+    "role": AGENT_CONFIG["role"],
+    "tools": AGENT_CONFIG["tools"],
+    "status": "active",
+    "features": ["streaming", "real-time_progress"]
+})
+_HEALTH_BODY = _json_dumps({"status": "healthy", "agent": "Currency Rate Analyst"})
+
 @app.get("/")
 async def root():
-    return {
-        "message": "Welcome to Currency Rate Analyst",
-        "role": "Financial Data Analyst specializing in currency conversion rates",
-        "agent_id": "ui_user_2e538485",
-        "endpoints": [
-            "/query - POST: Send a task to the agent",
-            "/stream - POST: Stream agent progress in real-time",
-            "/info - GET: Get agent information",
-            "/health - GET: Check service health"
-        ]
-    }
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.get("/info")
 async def get_agent_info():
-    return {
-        "agent_id": "ui_user_2e538485",
-        "name": AGENT_CONFIG["name"],
-        "role": AGENT_CONFIG["role"],
-        "tools": AGENT_CONFIG["tools"],
-        "status": "active",
-        "features": ["streaming", "real-time_progress"]
-    }
+    return Response(content=_INFO_BODY, media_type="application/json")
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "agent": "Currency Rate Analyst"}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
+
+# (monotonic_ns, isoformat, UTF-8 isoformat) of the last timestamp handed out
+_ts_cache = [0, "", b""]
+
+def _now_iso() -> str:
+    """
+    Current local time in ISO format, refreshed at most once per millisecond;
+    SSE timestamps are advisory, so sharing one across a burst is fine
+    """
+    t = time.monotonic_ns()
+    if t - _ts_cache[0] > 1_000_000:
+        _ts_cache[0] = t
+        _ts_cache[1] = datetime.datetime.now().isoformat()
+        _ts_cache[2] = _ts_cache[1].encode()
+    return _ts_cache[1]
 
-async def stream_agent_progress(request: QueryRequest) -> AsyncGenerator[str, None]:
+def _now_iso_bytes() -> bytes:
     """
-    Stream agent progress in real-time
+    _now_iso() pre-encoded for splicing into SSE frames
     """
-    def create_event(event_type: str, data: dict) -> str:
+    _now_iso()
+    return _ts_cache[2]
+
+def _event_head(event_type: str, data: dict) -> bytes:
+    """
+    Pre-encode an SSE frame up to the end of its constant data fields,
+    leaving the data object open for per-event fields
+    """
+    return b'data: {"type":' + _json_dumps(event_type) + b',"data":' + _json_dumps(data)[:-1]
+
+# Closes the data object and opens the timestamp string
+_EVT_DATA_END = b'},"timestamp":"'
+_EVT_END = b'"}\n\n'
+
+# Pre-encoded frames for the hot event kinds; only the variable tail is
+# serialized per event
+_EVT_INITIALIZING = _event_head("progress", {
+    "message": "🤖 Starting Currency Rate Analyst...",
+    "agent": AGENT_CONFIG["name"],
+    "status": "initializing"
+}) + _EVT_DATA_END
+_EVT_PROCESSING = _event_head("progress", {
+    "message": "📋 Processing your request...",
+    "status": "processing"
+}) + _EVT_DATA_END
+_EVT_RESPONSE_PREFIX = _event_head("response", {
+    "partial": True,
+    "message": "💭 Agent thinking..."
+}) + b',"content":'
+_EVT_TOOL_USE_PREFIX = _event_head("tool_use", {"status": "executing"}) + b',"tool":'
+
+def _text_frame(block: TextBlock, response_buf: bytearray | None) -> bytes:
+    """
+    Frame a text block as a partial response, recording it in the running
+    response when one is being kept
+    """
+    if response_buf is not None:
+        response_buf.extend(block.text.encode())
+        response_buf.append(10)
+    return (_EVT_RESPONSE_PREFIX + _json_dumps(block.text)
+            + _EVT_DATA_END + _now_iso_bytes() + _EVT_END)
+
+def _tool_use_frame(block: ToolUseBlock, response_buf: bytearray | None) -> bytes:
+    """
+    Frame a tool invocation as a tool_use event
+    """
+    return (_EVT_TOOL_USE_PREFIX + _json_dumps(block.name)
+            + b',"input":' + _json_dumps(block.input)
+            + b',"message":' + _json_dumps(f"🔧 Using {block.name} tool...")
+            + _EVT_DATA_END + _now_iso_bytes() + _EVT_END)
+
+# SSE frame builders keyed by exact content block type; other blocks aren't streamed
+_BLOCK_FRAMES = {
+    TextBlock: _text_frame,
+    ToolUseBlock: _tool_use_frame,
+}
+
+# SSE comment frame sent when the agent has been silent for SSE_KEEPALIVE_SECONDS
+SSE_KEEPALIVE_SECONDS = 15
+_SSE_PING = b": ping\n\n"
+# Upper bound on the bytes of queued frames merged into a single write
+SSE_COALESCE_BYTES = 8192
+# Frames buffered between the agent and the socket before the agent is paused
+SSE_QUEUE_SIZE = 32
+_STREAM_END = object()
+
+async def stream_agent_progress(request: QueryRequest, include_full: bool = False) -> AsyncGenerator[bytes, None]:
+    """
+    Stream agent progress in real-time. The text has already been streamed
+    as response events, so the complete event only repeats it in full when
+    include_full is set.
+    """
+    def create_event(event_type: str, data: dict) -> bytes:
         event = {
             "type": event_type,
             "data": data,
-            "timestamp": datetime.datetime.now().isoformat()
+            "timestamp": _now_iso()
         }
-        return f"data: {json.dumps(event)}\n\n"
+        return b"data: " + _json_dumps(event) + b"\n\n"
     
     try:
         # Send initial event
-        yield create_event("progress", {
-            "message": "🤖 Starting Currency Rate Analyst...",
-            "agent": AGENT_CONFIG["name"],
-            "status": "initializing"
-        })
+        yield _EVT_INITIALIZING + _now_iso_bytes() + _EVT_END
         
         # Create Claude Agent SDK options
-        options = ClaudeAgentOptions(
-            allowed_tools=AGENT_CONFIG["tools"],
-            system_prompt=AGENT_CONFIG["system_prompt"],
-            permission_mode=AGENT_CONFIG["permission_mode"],
-            max_turns=request.max_turns,
-        )
+        options = _options_for(request.max_turns)
         
-        yield create_event("progress", {
-            "message": "📋 Processing your request...",
-            "status": "processing"
-        })
+        yield _EVT_PROCESSING + _now_iso_bytes() + _EVT_END
         
         # Execute the query and stream progress
-        response_parts = []
+        # UTF-8 text blocks, each followed by a newline separator
+        response_buf = bytearray() if include_full else None
         usage_info = None
         
-        async for message in query(prompt=request.prompt, options=options):
-            if isinstance(message, AssistantMessage):
-                for block in message.content:
-                    if isinstance(block, TextBlock):
-                        response_parts.append(block.text)
-                        # Stream partial response
-                        yield create_event("response", {
-                            "content": block.text,
-                            "partial": True,
-                            "message": "💭 Agent thinking..."
-                        })
-                    elif isinstance(block, ToolUseBlock):
-                        # Stream tool usage
-                        yield create_event("tool_use", {
-                            "tool": block.name,
-                            "input": block.input,
-                            "message": f"🔧 Using {block.name} tool...",
-                            "status": "executing"
-                        })
-            elif isinstance(message, ResultMessage):
-                usage_info = {
-                    "duration_ms": message.duration_ms,
-                    "total_cost_usd": message.total_cost_usd,
-                    "num_turns": message.num_turns,
-                    "session_id": message.session_id
-                }
-                break
+        # aclosing() shuts the SDK query (and its CLI subprocess) down in this
+        # task, whether we stop at the result, on error or on cancellation
+        async with contextlib.aclosing(query(prompt=request.prompt, options=options)) as messages:
+            async for message in messages:
+                # Exact type checks; the SDK yields these classes, never subclasses
+                message_type = type(message)
+                if message_type is AssistantMessage:
+                    for block in message.content:
+                        # Stream partial responses and tool usage
+                        frame_for = _BLOCK_FRAMES.get(type(block))
+                        if frame_for is not None:
+                            yield frame_for(block, response_buf)
+                elif message_type is ResultMessage:
+                    usage_info = {
+                        "duration_ms": message.duration_ms,
+                        "total_cost_usd": message.total_cost_usd,
+                        "num_turns": message.num_turns,
+                        "session_id": message.session_id
+                    }
+                    break
         
-        full_response = "\n".join(response_parts) if response_parts else "No response received"
-        
-        # Send completion event
-        yield create_event("complete", {
-            "response": full_response,
+        complete = {
             "usage": usage_info or {},
             "status": "completed",
             "message": "✅ Task completed successfully!",
@@ -171,7 +282,12 @@ async def stream_agent_progress(request: QueryRequest) -> AsyncGenerator[str, No
                 "name": AGENT_CONFIG["name"],
                 "role": AGENT_CONFIG["role"]
             }
-        })
+        }
+        if include_full:
+            complete["response"] = response_buf[:-1].decode() if response_buf else "No response received"
+        
+        # Send completion event
+        yield create_event("complete", complete)
         
     except Exception as e:
         yield create_event("error", {
@@ -180,47 +296,158 @@ async def stream_agent_progress(request: QueryRequest) -> AsyncGenerator[str, No
             "status": "failed"
         })
 
-@app.post("/stream")
-async def stream_query(request: QueryRequest):
+async def _with_keepalive(events: AsyncGenerator[bytes, None], raw_request: Request) -> AsyncGenerator[bytes, None]:
     """
-    Stream agent progress in real-time using Server-Sent Events (SSE)
+    Relay SSE frames, emitting a ping comment whenever none arrives within
+    SSE_KEEPALIVE_SECONDS so proxies don't drop the connection during long
+    tool calls. The source generator is drained by a background pump task
+    into a bounded queue, so the SDK's query() keeps running while the
+    socket is busy (and is iterated from a single task, as it must be);
+    frames that pile up meanwhile are sent together in one write. The pump
+    is cancelled once the client disconnects, so an abandoned agent turn
+    stops instead of running to completion.
     """
-    return StreamingResponse(
-        stream_agent_progress(request),
+    queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+
+    async def pump():
+        # Ends the queue with _STREAM_END, or with the exception that stopped
+        # the source; cancellation needs no marker as nobody is reading
+        end = _STREAM_END
+        try:
+            # Closed here, in the task that iterates it, even when cancelled
+            # while blocked on a full queue
+            async with contextlib.aclosing(events):
+                async for frame in events:
+                    await queue.put(frame)
+        except Exception as e:
+            end = e
+        await queue.put(end)
+
+    pump_task = asyncio.create_task(pump())
+    getter = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait((getter,), timeout=SSE_KEEPALIVE_SECONDS)
+            if not done:
+                yield _SSE_PING
+            else:
+                frame = getter.result()
+                getter = None
+                # Coalesce frames that are already queued into a single write
+                batch = []
+                size = 0
+                while isinstance(frame, bytes):
+                    batch.append(frame)
+                    size += len(frame)
+                    if size >= SSE_COALESCE_BYTES or queue.empty():
+                        break
+                    frame = queue.get_nowait()
+                if batch:
+                    yield b"".join(batch)
+                if frame is _STREAM_END:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
+            # Stop pulling from the agent as soon as the client is gone
+            if await raw_request.is_disconnected():
+                break
+    finally:
+        if getter is not None:
+            getter.cancel()
+        pump_task.cancel()
+        # No cancel scope is held across the yields above, so waiting for
+        # the pump here is safe whichever task closes this generator
+        await asyncio.wait((pump_task,))
+
+class SSEResponse(StreamingResponse):
+    """
+    StreamingResponse that always closes its event generator. Starlette
+    cancels the response task on disconnect, possibly while blocked in
+    send(); closing here runs _with_keepalive's cleanup in this task instead
+    of leaving it to garbage collection.
+    """
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+async def _parse_query_request(raw_request: Request) -> QueryRequest:
+    """
+    Validate the raw JSON body with pydantic-core in a single pass, skipping
+    FastAPI's json.loads-then-validate dict round trip
+    """
+    try:
+        return QueryRequest.model_validate_json(await raw_request.body())
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])}
+            for error in e.errors(include_url=False)
+        ]) from e
+
+# The endpoints read QueryRequest from the raw body, so document it explicitly
+_QUERY_REQUEST_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": QueryRequest.model_json_schema()}}
+    }
+}
+
+# Response headers shared by every /stream response; Starlette copies them
+# into each response, so one module-level dict is safe to reuse.
+# SSE must never be compressed: gzip/brotli middleware buffers output and
+# breaks per-event flushing. Any compression middleware added to this app
+# has to skip text/event-stream by media type; Starlette's GZipMiddleware
+# does so by default from 0.46, the minimum version pinned in pyproject.toml.
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "*",
+}
+
+@app.post("/stream", openapi_extra=_QUERY_REQUEST_OPENAPI)
+async def stream_query(raw_request: Request, include_full: bool = False):
+    """
+    Stream agent progress in real-time using Server-Sent Events (SSE).
+    Pass ?include_full=true to also receive the whole response text in the
+    complete event.
+    """
+    request = await _parse_query_request(raw_request)
+    return SSEResponse(
+        _with_keepalive(stream_agent_progress(request, include_full), raw_request),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-            "Access-Control-Allow-Headers": "*",
-        }
+        headers=_SSE_HEADERS
     )
 
-@app.post("/query", response_model=QueryResponse)
-async def query_agent(request: QueryRequest):
+@app.post("/query", response_model=QueryResponse, openapi_extra=_QUERY_REQUEST_OPENAPI)
+async def query_agent(raw_request: Request):
     """
     Send a query/task to the Currency Rate Analyst (non-streaming)
     """
+    request = await _parse_query_request(raw_request)
     try:
         # Create Claude Agent SDK options
-        options = ClaudeAgentOptions(
-            allowed_tools=AGENT_CONFIG["tools"],
-            system_prompt=AGENT_CONFIG["system_prompt"],
-            permission_mode=AGENT_CONFIG["permission_mode"],
-            max_turns=request.max_turns,
-        )
+        options = _options_for(request.max_turns)
         
         # Execute the query
-        response_parts = []
+        # UTF-8 text blocks, each followed by a newline separator
+        response_buf = bytearray()
         usage_info = None
         
         async for message in query(prompt=request.prompt, options=options):
-            if isinstance(message, AssistantMessage):
+            # Exact type checks; the SDK yields these classes, never subclasses
+            message_type = type(message)
+            if message_type is AssistantMessage:
                 for block in message.content:
-                    if isinstance(block, TextBlock):
-                        response_parts.append(block.text)
-            elif isinstance(message, ResultMessage):
+                    if type(block) is TextBlock:
+                        response_buf.extend(block.text.encode())
+                        response_buf.append(10)
+            elif message_type is ResultMessage:
                 usage_info = {
                     "duration_ms": message.duration_ms,
                     "total_cost_usd": message.total_cost_usd,
@@ -229,21 +456,27 @@ async def query_agent(request: QueryRequest):
                 }
                 break
         
-        full_response = "\n".join(response_parts) if response_parts else "No response received"
+        full_response = response_buf[:-1].decode() if response_buf else "No response received"
         
-        return QueryResponse(
-            status="success",
-            response=full_response,
-            usage=usage_info or {},
-            agent_info={
+        # Returned directly so FastAPI skips response_model re-validation
+        return ORJSONResponse({
+            "status": "success",
+            "response": full_response,
+            "usage": usage_info or {},
+            "agent_info": {
                 "name": AGENT_CONFIG["name"],
                 "role": AGENT_CONFIG["role"]
             }
-        )
+        })
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Agent execution failed: {str(e)}")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8002)
+    # uvloop has no Windows builds; fall back to the stdlib asyncio loop there
+    loop = "uvloop" if sys.platform != "win32" else "asyncio"
+    # Handlers keep no per-process state, so SSE streams fan out across one
+    # worker process per core; WEB_CONCURRENCY overrides the count
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 2))
+    uvicorn.run("main:app", host="0.0.0.0", port=8002, workers=workers, loop=loop, http="httptools")